@@ -1,19 +1,27 @@
 import asyncio
-import json
-from contextlib import redirect_stdout
+import functools
+import orjson
 from io import StringIO
 from typing import Any, Callable, TypedDict, List
 import google.generativeai as genai
 from dotenv import load_dotenv
 import os
 import sqlite3
+import threading
+import joblib
+import numpy as np
 import pandas as pd
+from sklearn.ensemble import IsolationForest
 
 load_dotenv()
 
 from anthropic import AsyncAnthropic
 from anthropic.types import MessageParam, ToolUnionParam
 
+# One shared client so all concurrent runs reuse the same warm HTTP connection
+# pool instead of each paying TLS handshake + pool setup.
+_CLIENT = AsyncAnthropic(max_retries=2, timeout=60.0)
+
 class PythonExpressionToolResult(TypedDict):
     result: Any
     error: str | None
@@ -26,7 +34,8 @@ class SubmitAnswerToolResult(TypedDict):
 
 class SqlQueryToolResult(TypedDict):
     """Return type for the sql_query_tool."""
-    result_json: str | None
+    result: list[dict] | None
+    n_rows: int | None
     error: str | None
 
 class BusinessContextToolResult(TypedDict):
@@ -35,18 +44,72 @@ class BusinessContextToolResult(TypedDict):
     error: str | None
 
 
+# The agent loop issues many read-only queries against a DB that is only a few
+# hundred KB, so we serve them all from ONE in-memory copy instead of paying
+# connect()/close(), file locking and page-cache misses on every tool call.
+_DB_PATH = 'analytics.db'
+_DB_LOCK = threading.Lock()
+# Rows fetched per chunk so a stray "SELECT * FROM transactions" stays
+# O(chunk) in memory instead of materializing the whole result at once.
+_CHUNK_ROWS = 10000
+# Cap on rows handed back to the model — anything past this just burns prompt
+# tokens; n_rows in the result tells the model how much was truncated.
+_MAX_RESULT_ROWS = 1000
+_db_conn: sqlite3.Connection | None = None
+_db_conn_mtime: float | None = None
+
+
+def _get_db_conn() -> sqlite3.Connection:
+    """
+    Returns an in-memory copy of analytics.db, (re)built via the sqlite3
+    backup API whenever the file on disk changes.
+    """
+    global _db_conn, _db_conn_mtime
+    mtime = os.path.getmtime(_DB_PATH)
+    if _db_conn is None or mtime != _db_conn_mtime:
+        if _db_conn is not None:
+            _db_conn.close()
+        mem = sqlite3.connect(':memory:', check_same_thread=False)
+        disk = sqlite3.connect(f'file:{_DB_PATH}?mode=ro', uri=True)
+        disk.backup(mem)
+        disk.close()
+        _db_conn = mem
+        _db_conn_mtime = mtime
+    return _db_conn
+
+
+@functools.lru_cache(maxsize=256)
+def _cached_query(query: str, db_mtime: float) -> tuple[list[dict], int]:
+    """
+    Runs the query against the in-memory DB copy and returns (records, n_rows).
+    db_mtime is only part of the cache key, so entries invalidate whenever
+    analytics.db is rebuilt.
+    """
+    # Stream the result in chunks; keep at most _MAX_RESULT_ROWS records
+    # while still counting the full row total for the n_rows metadata.
+    records: list[dict] = []
+    n_rows = 0
+    with _DB_LOCK:
+        for chunk in pd.read_sql_query(query, _get_db_conn(), chunksize=_CHUNK_ROWS):
+            n_rows += len(chunk)
+            if len(records) < _MAX_RESULT_ROWS:
+                records.extend(chunk.head(_MAX_RESULT_ROWS - len(records)).to_dict(orient='records'))
+    return records, n_rows
+
+
 def sql_query_tool(query: str) -> SqlQueryToolResult:
     """
-    Executes a read-only SQL query against the 'analytics.db' database
-    and returns the result as a JSON string.
+    Executes a read-only SQL query against the 'analytics.db' database and
+    returns the rows as native records (truncated to _MAX_RESULT_ROWS), so the
+    outer tool-result serializer encodes them exactly once. The agent runs
+    re-issue the same exploration queries constantly, so results are memoized
+    until the DB file changes.
     """
     try:
-        conn = sqlite3.connect('analytics.db')
-        df = pd.read_sql_query(query, conn)
-        conn.close()
-        return {"result_json": df.to_json(orient='records'), "error": None}
+        records, n_rows = _cached_query(query.strip(), os.path.getmtime(_DB_PATH))
+        return {"result": records, "n_rows": n_rows, "error": None}
     except Exception as e:
-        return {"result_json": None, "error": f"Error executing query: {str(e)}"}
+        return {"result": None, "n_rows": None, "error": f"Error executing query: {str(e)}"}
 
 def get_business_context() -> BusinessContextToolResult:
     """Provides strategic business context from leadership."""
@@ -60,16 +123,42 @@ def get_business_context() -> BusinessContextToolResult:
     except Exception as e:
         return {"context": None, "error": f"Error getting context: {str(e)}"}
     
+# Pre-imported modules for python_expression_tool. The AI's snippets almost
+# always start with "import pandas as pd" etc., and each cold import costs
+# 100+ ms — hand them the already-loaded modules instead.
+_PY_GLOBALS = {
+    "pd": pd,
+    "pandas": pd,
+    "np": np,
+    "numpy": np,
+    "sqlite3": sqlite3,
+    "IsolationForest": IsolationForest,
+    "joblib": joblib,
+    # data.py dumps one fitted forest per segment; loading it and calling
+    # .predict is 10-100x cheaper than re-fitting in every snippet.
+    "load_iso": lambda segment: joblib.load(f'iso_{segment}.joblib'),
+}
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_expression(expression: str):
+    """Compiles a tool expression once; the agent often retries identical snippets."""
+    return compile(expression, "<tool>", "exec")
+
+
 def python_expression_tool(expression: str) -> PythonExpressionToolResult:
     """
     Tool that evaluates Python expressions using exec.
     Use print(...) to emit output; stdout will be captured and returned.
     """
     try:
-        namespace = {}
+        namespace = _PY_GLOBALS.copy()
         stdout = StringIO()
-        with redirect_stdout(stdout):
-            exec(expression, namespace, namespace)
+        # Per-call print bound to a local buffer: no process-global
+        # sys.stdout swap, so concurrent snippets and the harness's own
+        # verbose prints can't leak into each other's captured output.
+        namespace["print"] = functools.partial(print, file=stdout)
+        exec(_compile_expression(expression), namespace, namespace)
         return {"result": stdout.getvalue(), "error": None}
     except KeyboardInterrupt:
         raise
@@ -91,6 +180,7 @@ async def run_agent_loop(
     max_steps: int = 10,
     model: str = "claude-3-5-haiku-latest",
     verbose: bool = True,
+    client: AsyncAnthropic = _CLIENT,
 ) -> Any | None:
     """
     Runs an agent loop with the given prompt and tools.
@@ -102,13 +192,119 @@ async def run_agent_loop(
         max_steps: Maximum number of steps before stopping (default 5)
         model: The Anthropic model to use
         verbose: Whether to print detailed output (default True)
+        client: The AsyncAnthropic client to use (defaults to the shared one)
 
     Returns:
         The submitted answer if submit_answer was called, otherwise None
     """
-    client = AsyncAnthropic()
     messages: list[MessageParam] = [{"role": "user", "content": prompt}]
 
+    # Per-step state; reset before each response walk below
+    has_tool_use = False
+    tool_results_dict: dict[str, dict] = {}
+    submitted_answer = None
+
+    async def _on_text(content) -> None:
+        if verbose:
+            print(f"Assistant: {content.text}")
+
+    async def _on_tool_use(content) -> None:
+        nonlocal has_tool_use, submitted_answer
+        has_tool_use = True
+        tool_name = content.name
+        tool_input = content.input
+        tool_use_id = content.id
+
+        if tool_name not in tool_handlers:
+            # The AI called a tool we don't have. We MUST provide an error result.
+            if verbose:
+                print(f"Error: Unknown tool '{tool_name}' called by AI.")
+
+            tool_results_dict[tool_use_id] = {
+                "type": "tool_result",
+                "tool_use_id": tool_use_id,
+                "content": orjson.dumps({"result": None, "error": f"Unknown tool name: {tool_name}"}).decode(),
+            }
+            return
+
+        if verbose:
+            print(f"Using tool: {tool_name}")
+
+        handler = tool_handlers[tool_name]
+        # Checked once here instead of per branch
+        is_dict_input = isinstance(tool_input, dict)
+
+        # Call the appropriate tool handler
+        if tool_name == "python_expression":
+            # We replace the brittle 'assert' with a robust if/else check
+            if is_dict_input and "expression" in tool_input:
+                # HAPPY PATH: The AI called the tool correctly
+                expression = tool_input["expression"]
+                if verbose:
+                    print("\nInput (Python Expression):")
+                    print("```")
+                    for line in expression.split("\n"):
+                        print(f"{line}")
+                    print("```")
+
+                # Call the handler (which is python_expression_tool) in a
+                # worker thread so the exec() doesn't block the event loop
+                # and other concurrent runs keep making progress.
+                result = await asyncio.to_thread(handler, expression)
+
+                if verbose:
+                    print("\nOutput:")
+                    print("```")
+                    print(result)
+                    print("```")
+            else:
+                # SAD PATH: The AI called the tool with bad arguments
+                if verbose:
+                    print(f"\nError: AI called 'python_expression' with invalid input: {tool_input}")
+
+                # We MUST provide an error 'result' to avoid a crash
+                result = {"result": None, "error": f"Invalid tool input. Expected a JSON object with an 'expression' key."}
+
+        elif tool_name == "sql_query_tool":
+            assert is_dict_input and "query" in tool_input
+            if verbose:
+                print("\nInput (SQL Query):")
+                print("```sql")
+                for line in tool_input["query"].split("\n"):
+                    print(f"{line}")
+                print("```")
+            # SQLite I/O + DataFrame building runs off the event loop
+            result = await asyncio.to_thread(handler, tool_input["query"])
+            if verbose:
+                print("\nOutput:")
+                print("```")
+                print(result)
+                print("```")
+
+        elif tool_name == "submit_answer":
+            assert is_dict_input and "answer" in tool_input
+            result = handler(tool_input["answer"])
+            submitted_answer = result["answer"]
+        else:
+            # Generic handler call
+            result = handler(**tool_input) if is_dict_input else handler(tool_input)
+
+        # --- Robust Error Handling ---
+        # Keying by tool_use_id prevents the harness from crashing if the AI
+        # sends duplicate IDs.
+        tool_results_dict[tool_use_id] = {
+            "type": "tool_result",
+            "tool_use_id": tool_use_id,
+            "content": orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY).decode(),
+        }
+
+    async def _on_unhandled(content) -> None:
+        return None
+
+    # One dispatch lookup per content block instead of re-walking the
+    # type/tool-name branches for every block.
+    _dispatch = {"text": _on_text, "tool_use": _on_tool_use}
+
     for step in range(max_steps):
         if verbose:
             print(f"\n=== Step {step + 1}/{max_steps} ===")
@@ -117,104 +313,13 @@ async def run_agent_loop(
             model=model, max_tokens=1000, tools=tools, messages=messages
         )
 
-        # Track if we need to continue
+        # Reset per-step state, then process the response in a single pass
         has_tool_use = False
-        # tool_results = []
         tool_results_dict = {}
         submitted_answer = None
 
-        # Process the response
         for content in response.content:
-            if content.type == "text":
-                if verbose:
-                    print(f"Assistant: {content.text}")
-            elif content.type == "tool_use":
-                has_tool_use = True
-                tool_name = content.name
-                tool_input = content.input
-                tool_use_id = content.id
-
-                if tool_name in tool_handlers:
-                    if verbose:
-                        print(f"Using tool: {tool_name}")
-
-                    # Extract arguments based on tool
-                    handler = tool_handlers[tool_name]
-                    tool_input = content.input
-
-                    # Call the appropriate tool handler
-                    if tool_name == "python_expression":
-                        # We replace the brittle 'assert' with a robust if/else check
-                        if isinstance(tool_input, dict) and "expression" in tool_input:
-                            # HAPPY PATH: The AI called the tool correctly
-                            expression = tool_input["expression"]
-                            if verbose:
-                                print("\nInput (Python Expression):")
-                                print("```")
-                                for line in expression.split("\n"):
-                                    print(f"{line}")
-                                print("```")
-                            
-                            # Call the handler (which is python_expression_tool)
-                            result = handler(expression)
-                            
-                            if verbose:
-                                print("\nOutput:")
-                                print("```")
-                                print(result)
-                                print("```")
-                        else:
-                            # SAD PATH: The AI called the tool with bad arguments
-                            if verbose:
-                                print(f"\nError: AI called 'python_expression' with invalid input: {tool_input}")
-                            
-                            # We MUST provide an error 'result' to avoid a crash
-                            result = {"result": None, "error": f"Invalid tool input. Expected a JSON object with an 'expression' key."}
-
-                    elif tool_name == "sql_query_tool":
-                        assert isinstance(tool_input, dict) and "query" in tool_input
-                        if verbose:
-                            print("\nInput (SQL Query):")
-                            print("```sql")
-                            for line in tool_input["query"].split("\n"):
-                                print(f"{line}")
-                            print("```")
-                        result = handler(tool_input["query"])
-                        if verbose:
-                            print("\nOutput:")
-                            print("```")
-                            print(result)
-                            print("```")
-                        
-                    elif tool_name == "submit_answer":
-                        assert isinstance(tool_input, dict) and "answer" in tool_input
-                        result = handler(tool_input["answer"])
-                        submitted_answer = result["answer"]
-                    else:
-                        # Generic handler call
-                        result = (
-                            handler(**tool_input)
-                            if isinstance(tool_input, dict)
-                            else handler(tool_input)
-                        )
-                    # --- Robust Error Handling ---
-                    # The following checks prevent the harness from crashing if the AI 
-                    # calls a tool with invalid arguments, an unknown name, or duplicate IDs.
-                    tool_results_dict[content.id] = {
-                    "type": "tool_result",
-                    "tool_use_id": content.id,
-                    "content": json.dumps(result),
-                    }
-                else:
-                    # The AI called a tool we don't have. We MUST provide an error result.
-                    if verbose:
-                        print(f"Error: Unknown tool '{tool_name}' called by AI.")
-                    
-                    tool_results_dict[tool_use_id] = {
-                        "type": "tool_result",
-                        "tool_use_id": tool_use_id,
-                        "content": json.dumps({"result": None, "error": f"Unknown tool name: {tool_name}"}),
-                    }
+            await _dispatch.get(content.type, _on_unhandled)(content)
         # If we have tool uses, add them to the conversation
         if has_tool_use:
             messages.append({"role": "assistant", "content": response.content})
@@ -299,7 +404,7 @@ async def main(concurrent: bool = True):
         },
         {
             "name": "sql_query_tool",
-            "description": "Executes a read-only SQL query against the 'analytics.db' database and returns the result as a JSON string.",
+            "description": "Executes a read-only SQL query against the 'analytics.db' database and returns the rows as a list of records (truncated to 1000 rows; 'n_rows' gives the full count).",
             "input_schema": {
                 "type": "object",
                 "properties": {